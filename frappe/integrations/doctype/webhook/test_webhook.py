@@ -1,7 +1,11 @@
 # Copyright (c) 2017, Frappe Technologies and Contributors
 # License: MIT. See LICENSE
 import json
+import re
 from contextlib import contextmanager
+from urllib.parse import unquote
+
+import responses
 
 import frappe
 from frappe.integrations.doctype.webhook.webhook import (
@@ -9,6 +13,7 @@ from frappe.integrations.doctype.webhook.webhook import (
 	get_webhook_data,
 	get_webhook_headers,
 )
+from frappe.model.document import bulk_insert
 from frappe.tests.utils import FrappeTestCase
 
 
@@ -19,13 +24,77 @@ def get_test_webhook(config):
 		wh.name = frappe.generate_hash()
 	wh.insert()
 	wh.reload()
-	try:
-		yield wh
-	finally:
-		wh.delete()
+	# no explicit cleanup, the per-test savepoint rollback undoes the insert
+	yield wh
+
+
+def mock_httpbin(request):
+	"""Echo the request url and JSON body back, like httpbin.org does."""
+	body = {"url": unquote(request.url), "json": json.loads(request.body) if request.body else {}}
+	return 200, {}, json.dumps(body)
 
 
 class TestWebhook(FrappeTestCase):
+	DYNAMIC_URL_TEMPLATE = "https://httpbin.org/anything/{{ doc.doctype }}"
+	DYNAMIC_URL_RENDERED = "https://httpbin.org/anything/Note"
+	UNRENDERED_URL_TEMPLATE = "https://httpbin.org/anything/{{doc.doctype}}"
+
+	_webhook_fields = {
+		"webhook_doctype": "User",
+		"webhook_docevent": "after_insert",
+		"request_url": "https://httpbin.org/post",
+	}
+
+	_array_body_webhook = {
+		"doctype": "Webhook",
+		"webhook_doctype": "Note",
+		"webhook_docevent": "after_insert",
+		"enabled": 1,
+		"request_url": "https://httpbin.org/post",
+		"request_method": "POST",
+		"request_structure": "JSON",
+		"webhook_json": '[\r\n{% for n in range(3) %}\r\n    {\r\n        "title": "{{ doc.title }}",\r\n        "n": {{ n }}\r\n    }\r\n    {%- if not loop.last -%}\r\n        , \r\n    {%endif%}\r\n{%endfor%}\r\n]',
+		"meets_condition": "Yes",
+		"webhook_headers": [
+			{
+				"key": "Content-Type",
+				"value": "application/json",
+			}
+		],
+	}
+
+	_dynamic_url_webhook = {
+		"doctype": "Webhook",
+		"webhook_doctype": "Note",
+		"webhook_docevent": "after_insert",
+		"enabled": 1,
+		"request_url": DYNAMIC_URL_TEMPLATE,
+		"is_dynamic_url": 1,
+		"request_method": "POST",
+		"request_structure": "JSON",
+		"webhook_json": "{}",
+		"meets_condition": "Yes",
+		"webhook_headers": [
+			{
+				"key": "Content-Type",
+				"value": "application/json",
+			}
+		],
+	}
+
+	_static_url_webhook = {
+		**_dynamic_url_webhook,
+		"request_url": UNRENDERED_URL_TEMPLATE,
+		"is_dynamic_url": 0,
+		# own list, `frappe.get_doc` updates the child rows in place
+		"webhook_headers": [
+			{
+				"key": "Content-Type",
+				"value": "application/json",
+			}
+		],
+	}
+
 	@classmethod
 	def setUpClass(cls):
 		# delete any existing webhooks
@@ -36,6 +105,22 @@ class TestWebhook(FrappeTestCase):
 		# create test webhooks
 		cls.create_sample_webhooks()
 
+		# serve httpbin.org in-process instead of hitting the network
+		cls.responses = responses.RequestsMock(assert_all_requests_are_fired=False)
+		cls.responses.add_callback(
+			responses.POST, re.compile(r"https://httpbin\.org/.*"), callback=mock_httpbin
+		)
+		cls.responses.start()
+		cls.addClassCleanup(cls.responses.stop)
+
+		# create a User document shared by all tests
+		# inserting it also primes `frappe.flags.webhooks` (reset above) with the sample
+		# webhooks, which `test_webhook_trigger_with_enabled_webhooks` relies on
+		cls.user = frappe.new_doc("User")
+		cls.user.first_name = frappe.mock("name")
+		cls.user.email = frappe.mock("email")
+		cls.user.insert(ignore_permissions=True)
+
 	@classmethod
 	def create_sample_webhooks(cls):
 		samples_webhooks_data = [
@@ -61,60 +146,57 @@ class TestWebhook(FrappeTestCase):
 		for wh_fields in samples_webhooks_data:
 			wh = frappe.new_doc("Webhook")
 			wh.update(wh_fields)
-			wh.insert()
 			cls.sample_webhooks.append(wh)
 
+		# fixtures are known to be valid, skip controller validations and hooks
+		bulk_insert("Webhook", cls.sample_webhooks)
+		frappe.cache().delete_value("webhooks")
+		frappe.flags.webhooks = None
+
 	@classmethod
 	def tearDownClass(cls):
-		# delete any existing webhooks
-		frappe.db.delete("Webhook")
+		# discard sample webhooks and the shared user
+		frappe.db.rollback()
+		frappe.cache().delete_value("webhooks")
 
 	def setUp(self):
+		frappe.db.savepoint("test_webhook")
+
 		# retrieve or create a User webhook for `after_insert`
-		webhook_fields = {
-			"webhook_doctype": "User",
-			"webhook_docevent": "after_insert",
-			"request_url": "https://httpbin.org/post",
-		}
-
-		if frappe.db.exists("Webhook", webhook_fields):
-			self.webhook = frappe.get_doc("Webhook", webhook_fields)
+		if frappe.db.exists("Webhook", self._webhook_fields):
+			self.webhook = frappe.get_doc("Webhook", self._webhook_fields)
 		else:
 			self.webhook = frappe.new_doc("Webhook")
-			self.webhook.update(webhook_fields)
-
-		# create a User document
-		self.user = frappe.new_doc("User")
-		self.user.first_name = frappe.mock("name")
-		self.user.email = frappe.mock("email")
-		self.user.save()
-
-		# Create another test user specific to this test
-		self.test_user = frappe.new_doc("User")
-		self.test_user.email = "user1@integration.webhooks.test.com"
-		self.test_user.first_name = "user1"
+			self.webhook.update(self._webhook_fields)
 
 	def tearDown(self) -> None:
-		self.user.delete()
-		self.test_user.delete()
+		frappe.db.rollback(save_point="test_webhook")
 		super().tearDown()
 
 	def test_webhook_trigger_with_enabled_webhooks(self):
 		"""Test webhook trigger for enabled webhooks"""
 
-		frappe.cache().delete_value("webhooks")
-		frappe.flags.webhooks = None
+		# Create another test user specific to this test
+		self.test_user = frappe.new_doc("User")
+		self.test_user.email = "user1@integration.webhooks.test.com"
+		self.test_user.first_name = "user1"
+
+		flags = frappe.flags
+		# webhooks map must already be loaded with the sample webhooks
+		self.assertIn("User", flags.webhooks)
 
 		# Insert the user to db
 		self.test_user.insert()
 
-		self.assertTrue("User" in frappe.flags.webhooks)
+		wh_list = flags.webhooks.get("User")
+		self.assertIsNotNone(wh_list)
 		# only 1 hook (enabled) must be queued
-		self.assertEqual(len(frappe.flags.webhooks.get("User")), 1)
-		self.assertTrue(self.test_user.email in frappe.flags.webhooks_executed)
-		self.assertEqual(
-			frappe.flags.webhooks_executed.get(self.test_user.email)[0], self.sample_webhooks[0].name
-		)
+		self.assertEqual(len(wh_list), 1)
+
+		enabled_webhook = self.sample_webhooks[0].name
+		executed = flags.webhooks_executed.get(self.test_user.email)
+		self.assertIsNotNone(executed)
+		self.assertEqual(executed[0], enabled_webhook)
 
 	def test_validate_doc_events(self):
 		"Test creating a submit-related webhook for a non-submittable DocType"
@@ -172,39 +254,17 @@ class TestWebhook(FrappeTestCase):
 		self.assertEqual(data, {"name": self.user.name})
 
 	def test_webhook_req_log_creation(self):
-		if not frappe.db.get_value("User", "user2@integration.webhooks.test.com"):
-			user = frappe.get_doc(
-				{"doctype": "User", "email": "user2@integration.webhooks.test.com", "first_name": "user2"}
-			).insert()
-		else:
-			user = frappe.get_doc("User", "user2@integration.webhooks.test.com")
+		user = frappe.get_doc(
+			{"doctype": "User", "email": "user2@integration.webhooks.test.com", "first_name": "user2"}
+		).insert()
 
-		webhook = frappe.get_doc("Webhook", {"webhook_doctype": "User"})
-		enqueue_webhook(user, webhook)
+		enqueue_webhook(user, self.sample_webhooks[0])
 
 		self.assertTrue(frappe.get_all("Webhook Request Log", pluck="name"))
 
 	def test_webhook_with_array_body(self):
 		"""Check if array request body are supported."""
-		wh_config = {
-			"doctype": "Webhook",
-			"webhook_doctype": "Note",
-			"webhook_docevent": "after_insert",
-			"enabled": 1,
-			"request_url": "https://httpbin.org/post",
-			"request_method": "POST",
-			"request_structure": "JSON",
-			"webhook_json": '[\r\n{% for n in range(3) %}\r\n    {\r\n        "title": "{{ doc.title }}",\r\n        "n": {{ n }}\r\n    }\r\n    {%- if not loop.last -%}\r\n        , \r\n    {%endif%}\r\n{%endfor%}\r\n]',
-			"meets_condition": "Yes",
-			"webhook_headers": [
-				{
-					"key": "Content-Type",
-					"value": "application/json",
-				}
-			],
-		}
-
-		with get_test_webhook(wh_config) as wh:
+		with get_test_webhook(self._array_body_webhook) as wh:
 			doc = frappe.new_doc("Note")
 			doc.title = "Test Webhook Note"
 
@@ -213,57 +273,17 @@ class TestWebhook(FrappeTestCase):
 			self.assertEqual(len(json.loads(log.response)["json"]), 3)
 
 	def test_webhook_with_dynamic_url_enabled(self):
-		wh_config = {
-			"doctype": "Webhook",
-			"webhook_doctype": "Note",
-			"webhook_docevent": "after_insert",
-			"enabled": 1,
-			"request_url": "https://httpbin.org/anything/{{ doc.doctype }}",
-			"is_dynamic_url": 1,
-			"request_method": "POST",
-			"request_structure": "JSON",
-			"webhook_json": "{}",
-			"meets_condition": "Yes",
-			"webhook_headers": [
-				{
-					"key": "Content-Type",
-					"value": "application/json",
-				}
-			],
-		}
-
-		with get_test_webhook(wh_config) as wh:
+		with get_test_webhook(self._dynamic_url_webhook) as wh:
 			doc = frappe.new_doc("Note")
 			doc.title = "Test Webhook Note"
 			enqueue_webhook(doc, wh)
 			log = frappe.get_last_doc("Webhook Request Log")
-			self.assertEqual(json.loads(log.response)["url"], "https://httpbin.org/anything/Note")
+			self.assertEqual(json.loads(log.response)["url"], self.DYNAMIC_URL_RENDERED)
 
 	def test_webhook_with_dynamic_url_disabled(self):
-		wh_config = {
-			"doctype": "Webhook",
-			"webhook_doctype": "Note",
-			"webhook_docevent": "after_insert",
-			"enabled": 1,
-			"request_url": "https://httpbin.org/anything/{{doc.doctype}}",
-			"is_dynamic_url": 0,
-			"request_method": "POST",
-			"request_structure": "JSON",
-			"webhook_json": "{}",
-			"meets_condition": "Yes",
-			"webhook_headers": [
-				{
-					"key": "Content-Type",
-					"value": "application/json",
-				}
-			],
-		}
-
-		with get_test_webhook(wh_config) as wh:
+		with get_test_webhook(self._static_url_webhook) as wh:
 			doc = frappe.new_doc("Note")
 			doc.title = "Test Webhook Note"
 			enqueue_webhook(doc, wh)
 			log = frappe.get_last_doc("Webhook Request Log")
-			self.assertEqual(
-				json.loads(log.response)["url"], "https://httpbin.org/anything/{{doc.doctype}}"
-			)
+			self.assertEqual(json.loads(log.response)["url"], self.UNRENDERED_URL_TEMPLATE)